@@ -60,6 +60,7 @@ class OverlapResults(object):
         if self.table is not None:
             self.num_objects = len(self.table)
             self.locals = { name: self.table[name] for name in self.table.colnames }
+        self._compiled_selectors = { }
         self.stamps = stamps
         self.bounds = bounds
         self.num_slices = num_slices
@@ -147,8 +148,13 @@ class OverlapResults(object):
         elif selector == 'NONE':
             return np.zeros(self.num_objects,dtype=bool)
         else:
+            # Avoid re-parsing a selector when select() is called again with the same string.
+            code = self._compiled_selectors.get(selector)
+            if code is None:
+                code = compile(selector,'<selector>','eval')
+                self._compiled_selectors[selector] = code
             try:
-                return eval(selector,self.locals)
+                return eval(code,self.locals)
             except NameError,e:
                 raise RuntimeError('%s in selector %r.' % (e.message,selector))
 
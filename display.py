@@ -7,12 +7,6 @@ import argparse
 
 import numpy as np
 
-import matplotlib.pyplot as plt
-import matplotlib.collections
-import matplotlib.colors
-import matplotlib.cm
-import matplotlib.patheffects
-
 import galsim
 
 import descwl
@@ -121,6 +115,12 @@ def main():
         print 'No pixels visible with --hide-background and --hide-selected.'
         return 0
 
+    # Defer the matplotlib imports to here so that they are not paid for when only
+    # printing help or exiting early because of invalid arguments.
+    import matplotlib.pyplot as plt
+    import matplotlib.colors
+    import matplotlib.cm
+
     # Load the analysis results file we will display from.
     try:
         reader = descwl.output.Reader.from_args(defer_stamp_loading = True,args = args)
@@ -162,29 +162,38 @@ def main():
         # Nothing is selected by default.
         selection = results.select('NONE',format='mask')
     # Add any specified groups to the selection with logical OR.
-    for identifier in args.group:
-        selected = results.select('grp_id==%d' % identifier,format='mask')
-        if not np.any(selected):
-            print 'WARNING: no group found with ID %d.' % identifier
-        selection = np.logical_or(selection,selected)
+    if args.group:
+        grp_id = np.asarray(results.table['grp_id'])
+        selection |= np.in1d(grp_id,args.group)
+        missing = set(args.group) - set(grp_id.tolist())
+        for identifier in args.group:
+            if identifier in missing:
+                print 'WARNING: no group found with ID %d.' % identifier
     # Add any specified galaxies to the selection with logical OR.
-    for identifier in args.galaxy:
-        selected = results.select('db_id==%d' % identifier,format='mask')
-        if not np.any(selected):
-            print 'WARNING: no galaxy found with ID %d.' % identifier
-        selection = np.logical_or(selection,selected)
-    selected_indices = np.arange(results.num_objects)[selection]
+    if args.galaxy:
+        db_id = np.asarray(results.table['db_id'])
+        selection |= np.in1d(db_id,args.galaxy)
+        missing = set(args.galaxy) - set(db_id.tolist())
+        for identifier in args.galaxy:
+            if identifier in missing:
+                print 'WARNING: no galaxy found with ID %d.' % identifier
+    selected_indices = np.flatnonzero(selection)
     if args.verbose:
         print 'Selected IDs:\n%s' % np.array(results.table['db_id'][selected_indices])
 
     # Do we have individual objects available for selection in the output file?
-    if np.any(selection) and not results.stamps:
+    if len(selected_indices) > 0 and not results.stamps:
         print 'Cannot display selected objects without any stamps available.'
         return -1
 
     # Build the image of selected objects (might be None).
     selected_image = results.get_subimage(selected_indices)
 
+    # Look up the full simulated image once since it is used in several places below.
+    survey_image = results.survey.image
+    survey_bounds = survey_image.bounds
+    survey_pixels = survey_image.array
+
     # Calculate our viewing bounds as (xmin,xmax,ymin,ymax) in floating-point pixels
     # relative to the image bottom-left corner. Also calculate view_bounds with
     # integer values that determine how to extract sub-images to display.
@@ -211,7 +220,7 @@ def main():
         xmin,xmax,ymin,ymax = (
             view_bounds.xmin,view_bounds.xmax+1,view_bounds.ymin,view_bounds.ymax+1)
     else:
-        view_bounds = results.survey.image.bounds
+        view_bounds = survey_bounds
         xmin,xmax,ymin,ymax = 0,results.survey.image_width,0,results.survey.image_height
     if args.verbose:
         vxmin = (xmin - 0.5*results.survey.image_width)*scale
@@ -222,7 +231,7 @@ def main():
             vxmin,vxmax,vymin,vymax)
         print 'View pixels in %r' % view_bounds
 
-    # Initialize a matplotlib figure to display our view bounds.
+    # Check that the requested view is not too big to display.
     view_width = float(xmax - xmin)
     view_height = float(ymax - ymin)
     if (view_width*args.magnification > args.max_view_size or
@@ -230,32 +239,30 @@ def main():
         print 'Requested view dimensions %d x %d too big. Increase --max-view-size if necessary.' % (
             view_width*args.magnification,view_height*args.magnification)
         return -1
-    fig_height = args.magnification*(view_height/args.dpi)
-    fig_width = args.magnification*(view_width/args.dpi)
-    figure = plt.figure(figsize = (fig_width,fig_height),frameon = False,dpi = args.dpi)
-    axes = plt.Axes(figure, [0., 0., 1., 1.])
-    axes.axis(xmin = xmin,xmax = xmax,ymin = ymin,ymax = ymax)
-    axes.set_axis_off()
-    figure.add_axes(axes)
 
     # Get the background and highlighted images to display, sized to our view.
+    # The highlighted image is only allocated when there is something to overlay.
     background = galsim.Image(bounds = view_bounds,dtype = np.float32,scale = scale)
-    highlighted = background.copy()
+    highlighted = None
+    has_background = False
     if not args.hide_background:
-        overlap = results.survey.image.bounds & view_bounds
+        overlap = survey_bounds & view_bounds
         if overlap.area() > 0:
-            background[overlap] = results.survey.image[overlap]
+            background[overlap] = survey_image[overlap]
+            has_background = True
     if not args.hide_selected and selected_image is not None:
         overlap = selected_image.bounds & view_bounds
         if overlap.area() > 0:
+            highlighted = galsim.Image(bounds = view_bounds,dtype = np.float32,scale = scale)
             highlighted[overlap] = selected_image[overlap]
-    if np.count_nonzero(highlighted.array) == 0:
-        if args.hide_background or np.count_nonzero(background.array) == 0:
+    # Only scan pixel values when an image overlaps the view, and stop at the first non-zero.
+    if highlighted is None or not highlighted.array.any():
+        if not has_background or not background.array.any():
             print 'There are no non-zero pixel values in the view window.'
             return -1
 
     # Prepare the z scaling.
-    zscale_pixels = results.survey.image.array
+    zscale_pixels = survey_pixels
     if selected_image:
         if selected_image.bounds.area() < 16:
             print 'WARNING: using full image for z-scaling since only %d pixel(s) selected.' % (
@@ -263,41 +270,107 @@ def main():
         else:
             zscale_pixels = selected_image.array
     # Clip large fluxes to a fixed percentile of the non-zero selected pixel values.
-    non_zero_pixels = (zscale_pixels != 0)
-    vmax = np.percentile(zscale_pixels[non_zero_pixels],q = (args.clip_hi_percentile))
+    # Use a partial sort to find the two order statistics bracketing the percentile and
+    # interpolate linearly between them, which matches np.percentile without a full sort.
+    non_zero_pixels = zscale_pixels[zscale_pixels != 0]
+    rank = 0.01*args.clip_hi_percentile*(non_zero_pixels.size - 1)
+    rank_lo = int(math.floor(rank))
+    rank_hi = min(rank_lo + 1,non_zero_pixels.size - 1)
+    partitioned = np.partition(non_zero_pixels,(rank_lo,rank_hi))
+    vmax = np.float32(
+        partitioned[rank_lo] + (rank - rank_lo)*(partitioned[rank_hi] - partitioned[rank_lo]))
     # Clip small fluxes to a fixed fraction of the mean sky noise.
-    vmin = args.clip_lo_noise_fraction*np.sqrt(results.survey.mean_sky_level)
+    vmin = np.float32(args.clip_lo_noise_fraction*np.sqrt(results.survey.mean_sky_level))
     if args.verbose:
         print 'Clipping pixel values to [%.1f,%.1f] detected electrons.' % (vmin,vmax)
 
-    # Define the z scaling function. See http://ds9.si.edu/ref/how.html#Scales
+    # Define the z scaling function, applied in place. See http://ds9.si.edu/ref/how.html#Scales
     def zscale(pixels):
-        return np.sqrt(pixels)
-
-    # Calculate the clipped and scaled pixel values to display.
-    highlighted_z = zscale((np.clip(highlighted.array,vmin,vmax) - vmin)/(vmax-vmin))
+        return np.sqrt(pixels,out = pixels)
+
+    # Clip and normalize pixel values to [0,1] then apply the z scaling. Only the clipped
+    # copy is allocated and all subsequent steps update it in place.
+    def clip_and_scale(pixels,vmin,vmax):
+        scaled = np.empty_like(pixels)
+        np.clip(pixels,vmin,vmax,out = scaled)
+        scaled -= vmin
+        scaled *= 1./(vmax-vmin)
+        return zscale(scaled)
+
+    # When the view will be displayed with less than one screen pixel per image pixel,
+    # decimate the images first rather than processing every pixel and letting matplotlib
+    # resample the result.
+    stride = max(1,int(math.floor(1./args.magnification)))
+    if args.verbose and stride > 1:
+        print 'Decimating displayed pixels by %d for magnification %g.' % (stride,args.magnification)
+
+    # Calculate the clipped and scaled pixel values to display. All of the display arrays
+    # below are kept in single precision, which is plenty for 8-bit output.
+    if highlighted is not None:
+        highlighted_z = clip_and_scale(highlighted.array[::stride,::stride],vmin,vmax)
     if args.add_noise:
-        vmin = args.clip_noise*np.sqrt(results.survey.mean_sky_level)
+        vmin = np.float32(args.clip_noise*np.sqrt(results.survey.mean_sky_level))
         if args.verbose:
             print 'Background pixels with noise clipped to [%.1f,%.1f].' % (vmin,vmax)
-    background_z = zscale((np.clip(background.array,vmin,vmax) - vmin)/(vmax-vmin))
+    background_z = clip_and_scale(background.array[::stride,::stride],vmin,vmax)
 
     # Convert the background image to RGB using the requested colormap.
-    # Drop the alpha channel [3], which is all ones anyway.
+    # Drop the alpha channel [3], which is all ones anyway. The colormap quantizes its
+    # input into cmap.N bins, so we tabulate it once and gather from the lookup table
+    # with the same binning rather than evaluating the colormap for every pixel.
     cmap = matplotlib.cm.get_cmap(args.colormap)
-    background_rgb = cmap(background_z)[:,:,:3]
+    lut = cmap(np.arange(cmap.N))[:,:3].astype(np.float32)
+    lut_index = (background_z*cmap.N).astype(np.intp)
+    np.minimum(lut_index,cmap.N - 1,out = lut_index)
 
     # Overlay the highlighted image using alpha blending.
     # http://en.wikipedia.org/wiki/Alpha_compositing#Alpha_blending
-    if args.highlight and args.highlight != 'none':
-        alpha = highlighted_z[:,:,np.newaxis]
-        color = np.array(matplotlib.colors.colorConverter.to_rgb(args.highlight))
-        final_rgb = alpha*color + background_rgb*(1.-alpha)
+    # The blend is evaluated in place as color + (background - color)*(1 - alpha), which is
+    # equivalent to alpha*color + background*(1 - alpha) but touches each pixel without
+    # allocating any new full-size temporary arrays. The final composite is built as 8-bit
+    # RGB values so that matplotlib does not need to convert it before rendering, truncating
+    # the same way as matplotlib's own conversion.
+    if highlighted is not None and args.highlight and args.highlight != 'none':
+        color = np.array(matplotlib.colors.colorConverter.to_rgb(args.highlight),dtype = np.float32)
+        one_minus_alpha = np.subtract(1.,highlighted_z,out = highlighted_z)
+        blended_rgb = lut[lut_index]
+        blended_rgb -= color
+        blended_rgb *= one_minus_alpha[:,:,np.newaxis]
+        blended_rgb += color
+        blended_rgb *= 255.
+        final_rgb = blended_rgb.astype(np.uint8)
     else:
-        final_rgb = background_rgb
+        # Without an overlay we can gather 8-bit colors directly from the lookup table.
+        final_rgb = (255.*lut).astype(np.uint8)[lut_index]
+
+    # Each decimated pixel covers stride x stride view pixels so the extent can overhang
+    # the view bounds slightly, but the axes limits clip this.
+    num_rows,num_cols = final_rgb.shape[:2]
+    extent = (view_bounds.xmin,view_bounds.xmin+num_cols*stride,
+        view_bounds.ymin,view_bounds.ymin+num_rows*stride)
+
+    # When we are only writing an output file with nothing to draw over the composite image,
+    # and each output pixel corresponds to exactly one composite pixel, write the pixels
+    # directly instead of rendering them through a matplotlib figure.
+    num_selected = len(selected_indices)
+    has_overlays = num_selected > 0 and (
+        not args.no_crosshair or args.info or args.match_info or args.draw_moments)
+    pixel_aligned = (args.magnification*stride == 1 and extent == (xmin,xmax,ymin,ymax))
+    if args.no_display and not has_overlays and pixel_aligned:
+        import matplotlib.image
+        matplotlib.image.imsave(args.output_name,final_rgb,origin = 'lower',dpi = args.dpi)
+        return 0
+
+    # Initialize a matplotlib figure to display our view bounds.
+    fig_height = args.magnification*(view_height/args.dpi)
+    fig_width = args.magnification*(view_width/args.dpi)
+    figure = plt.figure(figsize = (fig_width,fig_height),frameon = False,dpi = args.dpi)
+    axes = plt.Axes(figure, [0., 0., 1., 1.])
+    axes.axis(xmin = xmin,xmax = xmax,ymin = ymin,ymax = ymax)
+    axes.set_axis_off()
+    figure.add_axes(axes)
 
     # Draw the composite image.
-    extent = (view_bounds.xmin,view_bounds.xmax+1,view_bounds.ymin,view_bounds.ymax+1)
     axes.imshow(final_rgb,extent = extent,aspect = 'equal',origin = 'lower',
         interpolation = 'nearest')
 
@@ -307,91 +380,86 @@ def main():
         args.info = args.info.decode('string-escape')
     if args.match_info:
         args.match_info = args.match_info.decode('string-escape')
+    if args.info or args.match_info:
+        import matplotlib.patheffects
+
+    # Calculate the centroids of selected objects in user display coordinates.
+    selected_table = results.table[selected_indices]
+    x_centers = 0.5*results.survey.image_width + np.asarray(selected_table['dx'])/scale
+    y_centers = 0.5*results.survey.image_height + np.asarray(selected_table['dy'])/scale
+    # Calculate the centroids of any matched detected objects.
+    if args.match_catalog:
+        match_indices = np.asarray(selected_table['match'])
+        match_indices = match_indices[match_indices >= 0]
+        matched_table = detected[match_indices]
+        x_match_centers = np.asarray(matched_table['X_IMAGE']) - 0.5
+        y_match_centers = np.asarray(matched_table['Y_IMAGE']) - 0.5
+
+    # Draw a crosshair at the centroid of selected objects, using a single collection
+    # for all objects rather than one line artist per object. Use the default zorder of
+    # line artists so that the crosshairs are drawn above any ellipses.
+    if not args.no_crosshair and num_selected > 0:
+        axes.scatter(x_centers,y_centers,marker = '+',color = args.crosshair_color,
+            s = 576,linewidths = 2,zorder = 2)
+        if args.match_catalog and len(match_indices) > 0:
+            axes.scatter(x_match_centers,y_match_centers,marker = 'x',color = args.match_color,
+                s = 576,linewidths = 2,zorder = 2)
+
+    # Format all annotation labels up front so that an invalid format is reported
+    # before anything is drawn, and share one outline path effect between labels.
+    if args.info:
+        try:
+            annotations = [ args.info % info for info in selected_table ]
+        except IndexError:
+            print 'Invalid annotate-format %r' % args.info
+            return -1
+    if args.match_catalog and args.match_info:
+        try:
+            match_annotations = [ args.match_info % match_info for match_info in matched_table ]
+        except IndexError:
+            print 'Invalid match-format %r' % args.match_info
+            return -1
+    if args.info or args.match_info:
+        path_effects = None if args.outline_color is None else [
+            matplotlib.patheffects.withStroke(linewidth = 2,
+            foreground = args.outline_color)]
 
-    num_selected = len(selected_indices)
-    ellipse_centers = np.empty((num_selected,2))
-    ellipse_widths = np.empty(num_selected)
-    ellipse_heights = np.empty(num_selected)
-    ellipse_angles = np.empty(num_selected)
-    match_ellipse_centers = np.empty((num_selected,2))
-    match_ellipse_widths = np.empty(num_selected)
-    match_ellipse_heights = np.empty(num_selected)
-    match_ellipse_angles = np.empty(num_selected)
-    num_match_ellipses = 0
-    for index,selected in enumerate(selected_indices):
-        info = results.table[selected]
-        # Do we have a detected object matched to this simulated source?
-        match_info = None
-        if args.match_catalog and info['match'] >= 0:
-            match_info = detected[info['match']]
-        # Calculate the selected object's centroid position in user display coordinates.
-        x_center = (0.5*results.survey.image_width + info['dx']/scale)
-        y_center = (0.5*results.survey.image_height + info['dy']/scale)
-        if match_info is not None:
-            x_match_center = match_info['X_IMAGE']-0.5
-            y_match_center = match_info['Y_IMAGE']-0.5
-        # Draw a crosshair at the centroid of selected objects.
-        if not args.no_crosshair:
-            axes.plot(x_center,y_center,'+',color = args.crosshair_color,
-                markeredgewidth = 2,markersize = 24)
-            if match_info:
-                axes.plot(x_match_center,y_match_center,'x',color = args.match_color,
-                    markeredgewidth = 2,markersize = 24)
-        # Add annotation text if requested.
-        if args.info:
-            path_effects = None if args.outline_color is None else [
-                matplotlib.patheffects.withStroke(linewidth = 2,
-                foreground = args.outline_color)]
-            try:
-                annotation = args.info % info
-            except IndexError:
-                print 'Invalid annotate-format %r' % args.info
-                return -1
+    # Add annotation text if requested.
+    if args.info:
+        for annotation,x_center,y_center in zip(annotations,x_centers,y_centers):
             axes.annotate(annotation,xy = (x_center,y_center),xytext = (4,4),
                 textcoords = 'offset points',color = args.info_color,
                 fontsize = args.info_size,path_effects = path_effects)
-        if match_info and args.match_info:
-            path_effects = None if args.outline_color is None else [
-                matplotlib.patheffects.withStroke(linewidth = 2,
-                foreground = args.outline_color)]
-            try:
-                annotation = args.match_info % match_info
-            except IndexError:
-                print 'Invalid match-format %r' % args.match_info
-                return -1
+    if args.match_catalog and args.match_info:
+        for annotation,x_match_center,y_match_center in zip(
+            match_annotations,x_match_centers,y_match_centers):
             axes.annotate(annotation,xy = (x_match_center,y_match_center),
                 xytext = (4,4),textcoords = 'offset points',
                 color = args.info_color,fontsize = args.info_size,
                 path_effects = path_effects)
-        # Add a second-moments ellipse if requested.
-        if args.draw_moments:
-            ellipse_centers[index] = (x_center,y_center)
-            ellipse_widths[index] = info['a']/scale
-            ellipse_heights[index] = info['b']/scale
-            ellipse_angles[index] = np.degrees(info['beta'])
-            if match_info:
-                # This will only work if we have the necessary additional fields in the match catalog.
-                try:
-                    match_ellipse_centers[num_match_ellipses] = (x_match_center,y_match_center)
-                    match_ellipse_widths[num_match_ellipses] = match_info['A_IMAGE']
-                    match_ellipse_heights[num_match_ellipses] = match_info['B_IMAGE']
-                    match_ellipse_angles[num_match_ellipses] = match_info['THETA_IMAGE']
-                    num_match_ellipses += 1
-                except IndexError:
-                    pass
 
     # Draw any ellipses.
     if args.draw_moments:
+        import matplotlib.collections
+        ellipse_centers = np.column_stack((x_centers,y_centers))
+        ellipse_widths = np.asarray(selected_table['a'])/scale
+        ellipse_heights = np.asarray(selected_table['b'])/scale
+        ellipse_angles = np.degrees(selected_table['beta'])
         ellipses = matplotlib.collections.EllipseCollection(units = 'x',
             widths = ellipse_widths,heights = ellipse_heights,angles = ellipse_angles,
             offsets = ellipse_centers, transOffset = axes.transData)
         ellipses.set_facecolor('none')
         ellipses.set_edgecolor(args.ellipse_color)
         axes.add_collection(ellipses,autolim = True)
-        if num_match_ellipses > 0:
+        # Matched ellipses require additional fields in the match catalog.
+        match_ellipse_columns = ('A_IMAGE','B_IMAGE','THETA_IMAGE')
+        if (args.match_catalog and len(match_indices) > 0 and
+            all(name in detected.colnames for name in match_ellipse_columns)):
             ellipses = matplotlib.collections.EllipseCollection(units = 'x',
-                widths = match_ellipse_widths,heights = match_ellipse_heights,
-                angles = match_ellipse_angles,offsets = match_ellipse_centers,
+                widths = np.asarray(matched_table['A_IMAGE']),
+                heights = np.asarray(matched_table['B_IMAGE']),
+                angles = np.asarray(matched_table['THETA_IMAGE']),
+                offsets = np.column_stack((x_match_centers,y_match_centers)),
                 transOffset = axes.transData)
             ellipses.set_facecolor('none')
             ellipses.set_edgecolor(args.match_color)